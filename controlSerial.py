@@ -1,39 +1,116 @@
 import sys
+import math
 import json
 import serial
-import serial.tools.list_ports
 import socket
+import select
 import os
+import struct
 import threading
+import queue
+import time
+from collections import deque
 
 from PyQt6.QtWidgets import (
     QApplication, QWidget, QVBoxLayout, QPushButton, QComboBox,
     QLabel, QTextEdit, QHBoxLayout, QLineEdit, QStackedLayout
 )
 from PyQt6.QtCore import Qt, QThread, pyqtSignal, QPointF, QTimer
-from PyQt6.QtGui import QIcon, QPainter, QPen, QBrush, QColor, QMouseEvent, QTextCursor
+from PyQt6.QtGui import QIcon, QPixmap, QPainter, QPen, QBrush, QColor, QMouseEvent, QTextCursor
 
 CONFIG_FILE = "config.json"
 
+_list_ports_mod = None
+_ports_cache = {"t": float("-inf"), "v": []}
+
+
+def _comports():
+    # serial.tools.list_ports тянет платформенные API — импортируем при первом обращении
+    global _list_ports_mod
+    if _list_ports_mod is None:
+        from serial.tools import list_ports as _list_ports_mod
+    return _list_ports_mod.comports()
+
+
+def _list_ports(ttl=2.0):
+    now = time.monotonic()
+    if now - _ports_cache["t"] > ttl:
+        _ports_cache["v"] = [p.device for p in _comports()]
+        _ports_cache["t"] = now
+    return _ports_cache["v"]
+
+
+_cfg_cache = {}
+
+
+def _load_cfg(path=CONFIG_FILE):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return {}
+    key = (path, st.st_mtime_ns)
+    hit = _cfg_cache.get("k")
+    if hit and hit[0] == key:
+        return hit[1]
+    try:
+        with open(path, "r") as f:
+            cfg = json.load(f)
+    except json.JSONDecodeError:
+        return {}
+    _cfg_cache["k"] = (key, cfg)
+    return cfg
+
+
+def _set_low_latency(serial_port):
+    # USB-serial адаптеры по умолчанию копят данные до 16 мс — снижаем до 1 мс
+    if not sys.platform.startswith("linux"):
+        return
+    name = os.path.basename(serial_port.port)
+    try:
+        with open(f"/sys/bus/usb-serial/devices/{name}/latency_timer", "w") as f:
+            f.write("1")
+    except OSError:
+        pass
+    try:
+        serial_port.set_low_latency_mode(True)
+    except (AttributeError, OSError, ValueError):
+        pass
+
 
 class SerialReader(QThread):
     data_received = pyqtSignal(str)
+    _MAX_LINE = 4096
 
     def __init__(self, serial_port):
         super().__init__()
         self.serial_port = serial_port
         self.running = True
+        self._buf = bytearray()
 
     def run(self):
         while self.running:
             if self.serial_port and self.serial_port.is_open:
                 try:
-                    line = self.serial_port.readline().decode('utf-8').strip()
-                    if line:
-                        self.data_received.emit(line)
+                    # read() блокируется в ОС до прихода данных или таймаута порта
+                    n = self.serial_port.in_waiting
+                    chunk = self.serial_port.read(n if n else 1)
+                    if not chunk:
+                        self.msleep(1)
+                        continue
+                    self._buf += chunk
+                    while (i := self._buf.find(b"\n")) != -1:
+                        line = bytes(self._buf[:i]).decode('utf-8', 'replace').strip()
+                        del self._buf[:i + 1]
+                        if line:
+                            self.data_received.emit(line)
+                    if len(self._buf) > self._MAX_LINE:
+                        # Поток без перевода строки (например, неверная скорость) — отбрасываем
+                        self._buf.clear()
                 except Exception as e:
                     self.data_received.emit(f"Ошибка чтения: {e}")
                     self.running = False
+            else:
+                self.msleep(1)
 
     def stop(self):
         self.running = False
@@ -46,6 +123,7 @@ class UDPListener(threading.Thread):
         self.port = port
         self.callback = callback
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
         self.running = True
 
     def run(self):
@@ -53,10 +131,18 @@ class UDPListener(threading.Thread):
             self.sock.bind((self.ip, self.port))
             while self.running:
                 try:
-                    data, _ = self.sock.recvfrom(1024)
-                    if data:
-                        self.callback(data.decode('utf-8').strip())
-                except OSError as e:
+                    r, _, _ = select.select([self.sock], [], [], 0.5)
+                    if not r:
+                        continue
+                    # За одно пробуждение вычитываем все накопившиеся датаграммы
+                    while True:
+                        try:
+                            data, _ = self.sock.recvfrom(4096)
+                        except BlockingIOError:
+                            break
+                        if data:
+                            self.callback(data.decode('utf-8', 'replace').strip())
+                except (OSError, ValueError) as e:
                     if not self.running:
                         break  # сокет закрыт вручную
                     self.callback(f"UDP Error: {e}")
@@ -76,7 +162,8 @@ class JoystickWidget(QWidget):
         self.setFixedSize(200, 200)
         self.radius = 80
         self.center = QPointF(100, 100)
-        self.knob_pos = self.center
+        self.knob_pos = QPointF(self.center)
+        self._bg = None
         self.active = False
         self.target_speedL = 0
         self.target_speedR = 0
@@ -86,12 +173,29 @@ class JoystickWidget(QWidget):
         self.timer.timeout.connect(self.update_speeds)
         self.timer.start(30)
 
+    def _render_background(self):
+        # Фон джойстика не меняется — рисуем его один раз в pixmap
+        dpr = self.devicePixelRatioF()
+        self._bg = QPixmap(int(self.width() * dpr), int(self.height() * dpr))
+        self._bg.setDevicePixelRatio(dpr)
+        self._bg.fill(Qt.GlobalColor.transparent)
+        p = QPainter(self._bg)
+        p.setRenderHint(QPainter.RenderHint.Antialiasing)
+        p.setBrush(QBrush(QColor(230, 230, 230)))
+        p.setPen(QPen(Qt.GlobalColor.black, 2))
+        p.drawEllipse(self.center, self.radius, self.radius)
+        p.end()
+
+    def resizeEvent(self, event):
+        self._bg = None
+        super().resizeEvent(event)
+
     def paintEvent(self, event):
+        if self._bg is None or self._bg.devicePixelRatio() != self.devicePixelRatioF():
+            self._render_background()
         painter = QPainter(self)
+        painter.drawPixmap(0, 0, self._bg)
         painter.setRenderHint(QPainter.RenderHint.Antialiasing)
-        painter.setBrush(QBrush(QColor(230, 230, 230)))
-        painter.setPen(QPen(Qt.GlobalColor.black, 2))
-        painter.drawEllipse(self.center, self.radius, self.radius)
         dx = self.knob_pos.x() - self.center.x()
         dy = self.knob_pos.y() - self.center.y()
         if dx != 0 or dy != 0:
@@ -104,14 +208,21 @@ class JoystickWidget(QWidget):
     def mousePressEvent(self, event: QMouseEvent):
         self.active = True
         self.update_knob(event.pos())
+        if not self.timer.isActive():
+            self.timer.start(30)
 
     def mouseMoveEvent(self, event: QMouseEvent):
         if self.active:
             self.update_knob(event.pos())
+            if not self.timer.isActive():
+                self.timer.start(30)
 
     def mouseReleaseEvent(self, event: QMouseEvent):
+        if not self.timer.isActive():
+            self.timer.start(30)
         self.active = False
-        self.knob_pos = self.center
+        self.knob_pos.setX(self.center.x())
+        self.knob_pos.setY(self.center.y())
         self.update()
         self.target_speedL = 0
         self.target_speedR = 0
@@ -119,19 +230,20 @@ class JoystickWidget(QWidget):
     def update_knob(self, pos: QPointF):
         dx = pos.x() - self.center.x()
         dy = pos.y() - self.center.y()
-        dist = (dx**2 + dy**2)**0.5
-        if dist > self.radius:
-            scale = self.radius / dist
-            dx *= scale
-            dy *= scale
-        self.knob_pos = QPointF(self.center.x() + dx, self.center.y() + dy)
+        d2 = dx * dx + dy * dy
+        if d2 > self.radius * self.radius:
+            inv = self.radius / math.sqrt(d2)
+            dx *= inv
+            dy *= inv
+        self.knob_pos.setX(self.center.x() + dx)
+        self.knob_pos.setY(self.center.y() + dy)
         self.update()
         norm_x = dx / self.radius
         norm_y = -dy / self.radius
         speedL = int((norm_y - norm_x) * 255)
         speedR = int((norm_y + norm_x) * 255)
-        self.target_speedL = max(-255, min(255, speedL))
-        self.target_speedR = max(-255, min(255, speedR))
+        self.target_speedL = -255 if speedL < -255 else 255 if speedL > 255 else speedL
+        self.target_speedR = -255 if speedR < -255 else 255 if speedR > 255 else speedR
 
     def update_speeds(self):
         def approach(current, target, step=15):
@@ -140,24 +252,46 @@ class JoystickWidget(QWidget):
             elif current > target:
                 return max(current - step, target)
             return current
+        if self.current_speedL == self.target_speedL and self.current_speedR == self.target_speedR:
+            self.timer.stop()
+            return
         self.current_speedL = approach(self.current_speedL, self.target_speedL)
         self.current_speedR = approach(self.current_speedR, self.target_speedR)
         self.moved.emit(self.current_speedL, self.current_speedR)
 
 
 class SerialController(QWidget):
-    
+
     def __init__(self):
         super().__init__()
-        self.current_data = {"speedL": 0, "speedR": 0, "brake": False, "limit": 1.0}
+        self.current_data = {"speedL": 0, "speedR": 0, "brake": False}
         self.serial_port = None
         self.reader_thread = None
         self.use_udp = False
         self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 262144)
+        self._udp_peer = None
         self.udp_ip = "127.0.0.1"
         self.udp_port = 5005
         self.udp_listener = None
+        self._tx_q = queue.Queue(maxsize=256)
+        self.last_packet = None
+        self._tx_buf = bytearray()
+        # Бинарный кадр: 0xA5, int16 L, int16 R, uint8 тормоз
+        self.binary_protocol = False
+        self._fmt = struct.Struct("<BhhB")
+        self._wire = bytearray(self._fmt.size)
+        self._pending_packet = None
+        self._flush_timer = QTimer()
+        self._flush_timer.setSingleShot(True)
+        self._flush_timer.timeout.connect(self._flush)
+        self._log_buf = deque()
+        self._tx_thread = threading.Thread(target=self._tx_worker, daemon=True)
+        self._tx_thread.start()
+        self._log_timer = QTimer()
+        self._log_timer.timeout.connect(self._flush_log)
         self.initUI()
+        self._log_timer.start(50)
         self.load_settings()
         self.setFocusPolicy(Qt.FocusPolicy.StrongFocus)
 
@@ -176,7 +310,7 @@ class SerialController(QWidget):
         self.refresh_button = QPushButton()
         self.refresh_button.setIcon(QIcon.fromTheme("view-refresh"))
         self.refresh_button.setFixedSize(24, 24)
-        self.refresh_button.clicked.connect(self.refresh_ports)
+        self.refresh_button.clicked.connect(lambda: self.refresh_ports(force=True))
         port_row = QHBoxLayout()
         port_row.addWidget(self.port_combo)
         port_row.addWidget(self.refresh_button)
@@ -229,6 +363,9 @@ class SerialController(QWidget):
 
         self.terminal_output = QTextEdit()
         self.terminal_output.setReadOnly(True)
+        self.terminal_output.document().setMaximumBlockCount(500)
+        self._end_cursor = self.terminal_output.textCursor()
+        self._end_cursor.movePosition(QTextCursor.MoveOperation.End)
         layout.addWidget(self.terminal_output)
 
         self.setLayout(layout)
@@ -241,10 +378,11 @@ class SerialController(QWidget):
         if self.use_udp:
             self.start_udp_listener()
 
-    def refresh_ports(self):
+    def refresh_ports(self, force=False):
+        if force:
+            _ports_cache["t"] = float("-inf")
         self.port_combo.clear()
-        ports = [p.device for p in serial.tools.list_ports.comports()]
-        self.port_combo.addItems(ports)
+        self.port_combo.addItems(_list_ports())
 
     def connect_serial(self):
         if self.serial_port and self.serial_port.is_open:
@@ -256,24 +394,25 @@ class SerialController(QWidget):
             self.port_combo.setEnabled(True)
             self.baud_combo.setEnabled(True)
             self.refresh_button.setEnabled(True)
-            self.terminal_output.append("Отключено")
+            self._log_buf.append("Отключено")
             return
 
         port = self.port_combo.currentText()
         baud = int(self.baud_combo.currentText())
         try:
             self.serial_port = serial.Serial(port, baud, timeout=1)
+            _set_low_latency(self.serial_port)
             self.connect_button.setText("Отключиться")
             self.port_combo.setEnabled(False)
             self.baud_combo.setEnabled(False)
             self.refresh_button.setEnabled(False)
-            self.terminal_output.append(f"Подключено к {port} @ {baud}")
+            self._log_buf.append(f"Подключено к {port} @ {baud}")
             self.save_settings(port, baud, self.ip_input.text(), self.port_input.text(), self.port_output.text())
             self.reader_thread = SerialReader(self.serial_port)
-            self.reader_thread.data_received.connect(self.terminal_output.append)
+            self.reader_thread.data_received.connect(self.filter_incoming)
             self.reader_thread.start()
         except serial.SerialException as e:
-            self.terminal_output.append(f"Ошибка подключения: {e}")
+            self._log_buf.append(f"Ошибка подключения: {e}")
             self.serial_port = None
 
     def start_udp_listener(self):
@@ -285,103 +424,140 @@ class SerialController(QWidget):
         try:
             port = int(self.port_output.text())
         except ValueError:
-            self.terminal_output.append("Ошибка: неверный порт UDP RX")
+            self._log_buf.append("Ошибка: неверный порт UDP RX")
             return
         self.udp_listener = UDPListener(ip, port, self.filter_incoming)
         self.udp_listener.start()
-        self.terminal_output.append(f"UDP RX слушает {ip}:{port}")
+        self._log_buf.append(f"UDP RX слушает {ip}:{port}")
     
     def save_settings(self, port, baud, udp_ip, udp_port, udp_port_out):
-        with open(CONFIG_FILE, "w") as f:
+        # Пишем во временный файл и атомарно подменяем, чтобы не оставить пустой конфиг
+        tmp = CONFIG_FILE + ".tmp"
+        with open(tmp, "w") as f:
             json.dump({
                 "port": port,
                 "baudrate": baud,
                 "udp_ip": udp_ip,
                 "udp_port": udp_port,
-                "udp_port_out": udp_port_out
+                "udp_port_out": udp_port_out,
+                "binary_protocol": self.binary_protocol
             }, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, CONFIG_FILE)
 
     def load_settings(self):
-        if os.path.exists(CONFIG_FILE):
-            with open(CONFIG_FILE, "r") as f:
-                cfg = json.load(f)
-            ports = [p.device for p in serial.tools.list_ports.comports()]
-            if cfg.get("port") in ports:
-                self.port_combo.setCurrentText(cfg["port"])
-            if "baudrate" in cfg:
-                self.baud_combo.setCurrentText(str(cfg["baudrate"]))
-            if "udp_ip" in cfg:
-                self.ip_input.setText(cfg["udp_ip"])
-            if "udp_port" in cfg:
-                self.port_input.setText(str(cfg["udp_port"]))
-            if "udp_port_out" in cfg:
-                self.port_output.setText(str(cfg["udp_port_out"]))
+        cfg = _load_cfg()
+        if not cfg:
+            return
+        if cfg.get("port") in _list_ports():
+            self.port_combo.setCurrentText(cfg["port"])
+        if "baudrate" in cfg:
+            self.baud_combo.setCurrentText(str(cfg["baudrate"]))
+        if "udp_ip" in cfg:
+            self.ip_input.setText(cfg["udp_ip"])
+        if "udp_port" in cfg:
+            self.port_input.setText(str(cfg["udp_port"]))
+        if "udp_port_out" in cfg:
+            self.port_output.setText(str(cfg["udp_port_out"]))
+        self.binary_protocol = bool(cfg.get("binary_protocol", False))
 
     
-    def send_data(self):
-        valL = int(self.current_data["speedL"] * self.current_data["limit"])
-        valR = int(self.current_data["speedR"] * self.current_data["limit"])
+    def send_data(self, immediate=False):
+        valL = self.current_data["speedL"]
+        valR = self.current_data["speedR"]
         b = 1 if self.current_data["brake"] else 0
-        packet_data = f"{valL},{valR},{b}"
-        packet = f"TX:{packet_data}\n"
-
-        if hasattr(self, "last_packet") and self.last_packet == packet:
+        if self.binary_protocol:
+            buf = self._wire
+            self._fmt.pack_into(buf, 0, 0xA5, valL, valR, b)
+        else:
+            buf = self._tx_buf
+            buf.clear()
+            buf += b"TX:"
+            buf += str(valL).encode('ascii')
+            buf += b","
+            buf += str(valR).encode('ascii')
+            buf += b",1\n" if b else b",0\n"
+
+        if buf == self.last_packet:
             return
+        packet = bytes(buf)
         self.last_packet = packet
 
+        # Отправляется только последний пакет за интервал таймера
+        self._pending_packet = packet
+        if immediate:
+            self._flush_timer.stop()
+            self._flush()
+        elif not self._flush_timer.isActive():
+            self._flush_timer.start(15)
+
+    def _flush(self):
+        packet = self._pending_packet
+        self._pending_packet = None
+        if packet is None:
+            return
+        if self.binary_protocol:
+            _, valL, valR, b = self._fmt.unpack(packet)
+            packet_data = f"{valL},{valR},{b}"
+        else:
+            packet_data = packet[3:-1].decode('ascii')
+
         if self.use_udp:
             self.udp_ip = self.ip_input.text()
             self.udp_port = int(self.port_input.text())
             try:
-                self.udp_socket.sendto(packet.encode('utf-8'), (self.udp_ip, self.udp_port))
-                self.terminal_output.append(f"Отправка: {packet_data}")
-                self.terminal_output.moveCursor(QTextCursor.MoveOperation.End)
-            except Exception as e:
-                self.terminal_output.append(f"Ошибка UDP: {e}")
+                self._tx_q.put_nowait((packet, (self.udp_ip, self.udp_port)))
+                self._log_buf.append(f"Отправка: {packet_data}")
+            except queue.Full:
+                pass  # управляющие пакеты идемпотентны, следующий перекроет
         else:
             if self.serial_port and self.serial_port.is_open:
                 try:
-                    self.serial_port.write(packet.encode('utf-8'))
-                    self.terminal_output.append(f"Отправка: {packet_data}")
-                    self.terminal_output.moveCursor(QTextCursor.MoveOperation.End)
+                    self.serial_port.write(packet)
+                    self._log_buf.append(f"Отправка: {packet_data}")
                 except Exception as e:
-                    self.terminal_output.append(f"Ошибка COM: {e}")
+                    self._log_buf.append(f"Ошибка COM: {e}")
+
+    def _tx_worker(self):
+        while True:
+            item = self._tx_q.get()
+            # Отправляем только самый свежий пакет из накопившихся
+            while True:
+                try:
+                    item = self._tx_q.get_nowait()
+                except queue.Empty:
+                    break
+            packet, addr = item
+            try:
+                # Закрепляем получателя через connect(), пересоединяемся при смене адреса
+                if addr != self._udp_peer:
+                    self.udp_socket.connect(addr)
+                    self._udp_peer = addr
+                try:
+                    self.udp_socket.send(packet)
+                except ConnectionRefusedError:
+                    # Отложенный ICMP от прошлой датаграммы: ошибка уже сброшена, повторяем
+                    self.udp_socket.send(packet)
+            except ConnectionRefusedError:
+                pass  # получатель по-прежнему не слушает
+            except OSError as e:
+                self._udp_peer = None
+                self._log_buf.append(f"Ошибка UDP: {e}")
+
+    def _flush_log(self):
+        if self._log_buf:
+            # В deque пишут и фоновые потоки: append/popleft потокобезопасны
+            lines = []
+            while self._log_buf:
+                lines.append(self._log_buf.popleft())
+            self.terminal_output.append("\n".join(lines))
+            self._end_cursor.movePosition(QTextCursor.MoveOperation.End)
+            self.terminal_output.setTextCursor(self._end_cursor)
 
     def filter_incoming(self, line):
         if line.startswith("RX:"):
-            self.terminal_output.append(f"{line}")
-            self.terminal_output.moveCursor(QTextCursor.MoveOperation.End)
-        
-    
-    def connect_serial(self):
-        if self.serial_port and self.serial_port.is_open:
-            if self.reader_thread:
-                self.reader_thread.stop()
-            self.serial_port.close()
-            self.serial_port = None
-            self.connect_button.setText("Подключиться")
-            self.port_combo.setEnabled(True)
-            self.baud_combo.setEnabled(True)
-            self.refresh_button.setEnabled(True)
-            self.terminal_output.append("Отключено")
-            return
-    
-        port = self.port_combo.currentText()
-        baud = int(self.baud_combo.currentText())
-        try:
-            self.serial_port = serial.Serial(port, baud, timeout=1)
-            self.connect_button.setText("Отключиться")
-            self.port_combo.setEnabled(False)
-            self.baud_combo.setEnabled(False)
-            self.refresh_button.setEnabled(False)
-            self.terminal_output.append(f"Подключено к {port} @ {baud}")
-            self.save_settings(port, baud, self.ip_input.text(), self.port_input.text())
-            self.reader_thread = SerialReader(self.serial_port)
-            self.reader_thread.data_received.connect(self.filter_incoming)
-            self.reader_thread.start()
-        except serial.SerialException as e:
-            self.terminal_output.append(f"Ошибка подключения: {e}")
-            self.serial_port = None
+            self._log_buf.append(f"{line}")
 
     def joystick_move(self, speedL, speedR):
         self.current_data["speedL"] = speedL
@@ -393,12 +569,12 @@ class SerialController(QWidget):
     def press_brake(self):
         self.current_data["brake"] = True
         self.brake_button.setStyleSheet("background-color: red;")
-        self.send_data()
+        self.send_data(immediate=True)
 
     def release_brake(self):
         self.current_data["brake"] = False
         self.brake_button.setStyleSheet("")
-        self.send_data()
+        self.send_data(immediate=True)
 
     def keyPressEvent(self, event):
         if event.key() == Qt.Key.Key_Space and not self.current_data["brake"]: